@@ -1,7 +1,12 @@
+import inspect
+import math
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from torch.utils.checkpoint import checkpoint
+
 
 # ATTRIBUTION: this implementation has been obtained from https://github.com/fepegar/highresnet
 # We thank Fernando Perez-Garcia for open sourcing his implementation
@@ -30,15 +35,52 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
-PADDING_MODES = {
-    'reflect': 'Reflection',
-    'replicate': 'Replication',
-    'constant': 'Zero',
-}
+# modes accepted by F.pad
+PADDING_MODES = {'reflect', 'replicate', 'constant'}
 
-BATCH_DIM = 0
 CHANNELS_DIM = 1
 
+# channels_last_3d is not available in older PyTorch releases
+CHANNELS_LAST_3D = getattr(torch, 'channels_last_3d', None)
+
+
+def _to_channels_last_3d(conv_layer):
+    conv_layer.weight.data = conv_layer.weight.data.contiguous(memory_format=CHANNELS_LAST_3D)
+
+
+# older PyTorch releases only provide the reentrant checkpoint implementation
+HAS_CHECKPOINT_USE_REENTRANT = 'use_reentrant' in inspect.signature(checkpoint).parameters
+
+# inference mode is not available in older PyTorch releases
+HAS_INFERENCE_MODE = hasattr(torch, 'is_inference_mode_enabled')
+
+# fused convolution + bias + ReLU kernel, not available in older PyTorch releases
+HAS_CUDNN_CONVOLUTION_RELU = hasattr(torch, 'cudnn_convolution_relu')
+
+
+# torch.compiler.is_compiling is not available in older PyTorch releases
+if hasattr(torch, 'compiler') and hasattr(torch.compiler, 'is_compiling'):
+    _is_compiling = torch.compiler.is_compiling
+else:
+    def _is_compiling():
+        return False
+
+
+def _tensor_version(tensor):
+    # inference tensors do not track a version counter
+    if HAS_INFERENCE_MODE and tensor.is_inference():
+        return None
+    return tensor._version
+
+
+@torch.no_grad()
+def _batch_norm_affine(norm):
+    """
+    Returns the per channel scale and shift that an evaluation mode batch norm applies to its input.
+    """
+    scale = norm.weight * torch.rsqrt(norm.running_var + norm.eps)
+    return scale, norm.bias - norm.running_mean * scale
+
 
 class ResidualBlock(nn.Module):
     def __init__(
@@ -53,13 +95,19 @@ class ResidualBlock(nn.Module):
             residual=True,
             residual_type='pad',
             padding_mode='constant',
+            use_checkpoint=False,
             ):
         assert residual_type in ('pad', 'project')
         super().__init__()
         self.residual = residual
+        # With checkpointing the residual branch runs twice per training step, its forward again during the
+        # backward pass. Batch norms therefore update their running statistics twice per step: the running averages
+        # move with an effective momentum of about twice the configured one and num_batches_tracked counts double.
+        self.use_checkpoint = use_checkpoint
         self.change_dimension = in_channels != out_channels
         self.residual_type = residual_type
         self.dimensions = dimensions
+        self.change_dim_layer = None
         if self.change_dimension:
             if residual_type == 'project':
                 conv_class = nn.Conv2d if dimensions == 2 else nn.Conv3d
@@ -70,6 +118,17 @@ class ResidualBlock(nn.Module):
                     dilation=dilation,
                     bias=False,  # as in NiftyNet and PyTorch's ResNet model
                 )
+                if dimensions == 3 and CHANNELS_LAST_3D is not None:
+                    _to_channels_last_3d(self.change_dim_layer)
+
+        # shortcut resolved once here rather than on every forward
+        self._pad_shortcut = self.change_dimension and residual_type == 'pad'
+        # F.pad starts from the last dimension, the channels come after the spatial ones
+        diff_channels = out_channels - in_channels
+        pad_low = diff_channels // 2
+        self._pad_channels = [0, 0] * dimensions + [pad_low, diff_channels - pad_low]
+        self._pad_low = pad_low
+        self._shortcut_buffer = None
 
         conv_blocks = nn.ModuleList()
         for _ in range(num_layers):
@@ -86,6 +145,64 @@ class ResidualBlock(nn.Module):
             in_channels = out_channels
         self.residual_block = nn.Sequential(*conv_blocks)
 
+    def train(self, mode=True):
+        super().train(mode)
+        self._shortcut_buffer = None
+        if not mode:
+            # In inference the pre-activation batch norm of every inner block is folded into the convolution of the
+            # previous block, whose output is its only input. It cannot be folded into the following convolution as
+            # the ReLU sits in between.
+            conv_blocks = list(self.residual_block)
+            for previous, conv_block in zip(conv_blocks[:-1], conv_blocks[1:]):
+                if (
+                        previous.preactivation
+                        and conv_block.preactivation
+                        and isinstance(conv_block.norm, nn.modules.batchnorm._BatchNorm)
+                ):
+                    # wrapped in a tuple so that the norm is not registered a second time as a submodule
+                    previous._output_norm = (conv_block.norm,)
+                    conv_block._norm_folded = True
+        return self
+
+    @torch.jit.unused
+    def _can_reuse_shortcut(self):
+        # type: () -> bool
+        # the compiler handles the allocations itself, mutating module state would only break its graph
+        return not torch.is_grad_enabled() and not _is_compiling()
+
+    @torch.jit.unused
+    def _padded_shortcut(self, x):
+        # type: (torch.Tensor) -> torch.Tensor
+        # Without autograd the zero padded shortcut is written into a buffer reused across calls. Only the middle
+        # channels are ever written to, the padding channels stay zero. The buffer is shared by all the calls to the
+        # module, which therefore must not run inference concurrently from several threads.
+        # The buffer is a whole padded activation of (batch, out_channels, *spatial) elements, kept for every pad
+        # shortcut until the next call to train() or eval(). With the default widths the two pad shortcuts hold 32 and
+        # 64 channels, 768 MiB per sample of 128^3 voxels in float32.
+        buffer = self._shortcut_buffer
+        if (
+                buffer is None
+                or buffer.shape[0] != x.shape[0]
+                or buffer.shape[2:] != x.shape[2:]
+                or buffer.dtype != x.dtype
+                or buffer.device != x.device
+                # inference tensors cannot be updated in place outside of inference mode
+                or (HAS_INFERENCE_MODE and buffer.is_inference() != torch.is_inference_mode_enabled())
+        ):
+            buffer = self._shortcut_buffer = F.pad(x, self._pad_channels)
+        else:
+            buffer[:, self._pad_low:self._pad_low + x.shape[CHANNELS_DIM]].copy_(x)
+        return buffer
+
+    @torch.jit.unused
+    def _checkpointed_forward(self, x):
+        # type: (torch.Tensor) -> torch.Tensor
+        # activations are recomputed during the backward pass instead of being stored
+        if HAS_CHECKPOINT_USE_REENTRANT:
+            return checkpoint(self.residual_block, x, use_reentrant=False)
+        # the reentrant version only propagates gradients if x requires them, as it does after the first convolution
+        return checkpoint(self.residual_block, x)
+
     def forward(self, x):
         """
         From the original ResNet paper, page 4:
@@ -98,22 +215,20 @@ class ResidualBlock(nn.Module):
         For both options, when the shortcuts go across feature maps of
         two sizes, they are performed with a stride of 2."
         """
-        out = self.residual_block(x)
+        if self.use_checkpoint and self.training and not torch.jit.is_scripting():
+            out = self._checkpointed_forward(x)
+        else:
+            out = self.residual_block(x)
         if self.residual:
-            if self.change_dimension:
-                if self.residual_type == 'project':
-                    x = self.change_dim_layer(x)
-                elif self.residual_type == 'pad':
-                    batch_size = x.shape[BATCH_DIM]
-                    x_channels = x.shape[CHANNELS_DIM]
-                    out_channels = out.shape[CHANNELS_DIM]
-                    spatial_dims = x.shape[2:]
-                    diff_channels = out_channels - x_channels
-                    zeros_half = x.new_zeros(
-                        batch_size, diff_channels // 2, *spatial_dims)
-                    x = torch.cat((zeros_half, x, zeros_half),
-                                  dim=CHANNELS_DIM)
-            out = x + out
+            if self.change_dim_layer is not None:
+                x = self.change_dim_layer(x)
+            elif self._pad_shortcut:
+                if not torch.jit.is_scripting() and self._can_reuse_shortcut():
+                    x = self._padded_shortcut(x)
+                else:
+                    x = F.pad(x, self._pad_channels)
+            # out is the output of the last convolution of the block and is not used anywhere else
+            out.add_(x)
         return out
 
 
@@ -131,17 +246,16 @@ class ConvolutionalBlock(nn.Module):
             kernel_size=3,
             activation=True,
             ):
-        assert padding_mode in PADDING_MODES.keys()
+        assert padding_mode in PADDING_MODES
         assert not (batch_norm and instance_norm)
         super().__init__()
 
-        if dimensions == 2:
-            # pylint: disable=not-callable
-            class_name = '{}Pad2d'.format(PADDING_MODES[padding_mode])
-            padding_class = getattr(nn, class_name)
-            padding_instance = padding_class(dilation)
-        elif dimensions == 3:
-            padding_instance = Pad3d(dilation, padding_mode)
+        self.preactivation = preactivation
+        self.kernel_size = kernel_size
+        # lists rather than tuples so that the block can be scripted with torch.jit
+        self._pad_spec = [dilation] * (2 * dimensions)
+        self._pad_mode = padding_mode
+
         conv_class = nn.Conv2d if dimensions == 2 else nn.Conv3d
 
         if batch_norm:
@@ -149,48 +263,237 @@ class ConvolutionalBlock(nn.Module):
         if instance_norm:
             norm_class = nn.InstanceNorm2d if dimensions == 2 else nn.InstanceNorm3d
 
-        layers = nn.ModuleList()
+        if batch_norm or instance_norm:
+            norm_channels = in_channels if preactivation else out_channels
+            self.norm = norm_class(norm_channels)
+        else:
+            self.norm = None
 
-        if preactivation:
-            if batch_norm or instance_norm:
-                layers.append(norm_class(in_channels))
-            if activation:
-                layers.append(nn.ReLU())
-
-        if kernel_size > 1:
-            layers.append(padding_instance)
+        self.activation = nn.ReLU() if activation else None
 
         use_bias = not (instance_norm or batch_norm)
-        conv_layer = conv_class(
-            in_channels,
-            out_channels,
-            kernel_size=kernel_size,
-            dilation=dilation,
-            bias=use_bias,
-        )
-        layers.append(conv_layer)
 
+        # A 1x1x1 convolution is a linear map over the channels of every voxel, which nn.Linear computes without the
+        # overhead of a cuDNN convolution
+        self._linear = kernel_size == 1 and dimensions == 3
+        if self._linear:
+            self.conv_layer = nn.Linear(in_channels, out_channels, bias=use_bias)
+        else:
+            # The bias is added after the convolution rather than by it: dilated convolutions with bias fall back
+            # to a much slower kernel in half precision
+            self.conv_layer = conv_class(
+                in_channels,
+                out_channels,
+                kernel_size=kernel_size,
+                dilation=dilation,
+                bias=False,
+            )
+        if use_bias and not self._linear:
+            # same initialization as the bias of torch.nn.Conv*d
+            bound = 1 / math.sqrt(in_channels * kernel_size ** dimensions)
+            self.bias_param = nn.Parameter(torch.empty(out_channels).uniform_(-bound, bound))
+        else:
+            self.register_parameter('bias_param', None)
+        self._bias_shape = [1, -1] + [1] * dimensions
+        self._channels_last = dimensions == 3 and CHANNELS_LAST_3D is not None
+        if self._channels_last and not self._linear:
+            _to_channels_last_3d(self.conv_layer)
+
+        # layers of the nn.Sequential that used to hold the block, to load older checkpoints
+        self._sequential_layers = []
+        if preactivation:
+            if self.norm is not None:
+                self._sequential_layers.append('norm')
+            if activation:
+                self._sequential_layers.append('activation')
+        if kernel_size > 1:
+            self._sequential_layers.append('padding')
+        self._sequential_layers.append('conv_layer')
         if not preactivation:
-            if batch_norm or instance_norm:
-                layers.append(norm_class(out_channels))
+            if self.norm is not None:
+                self._sequential_layers.append('norm')
             if activation:
-                layers.append(nn.ReLU())
-
-        self.convolutional_block = nn.Sequential(*layers)
-
-    def forward(self, x):
-        return self.convolutional_block(x)
-
+                self._sequential_layers.append('activation')
+
+        # conv -> norm -> ReLU can run as a single cuDNN kernel in inference once the batch norm is folded into the
+        # convolution. Restricted to 3x3 kernels, larger kernels can be slower with the fused kernel.
+        self._fusable = not preactivation and activation and not instance_norm and kernel_size == 3
+
+        # inference only state, see train and ResidualBlock.train
+        self._folded_params = None
+        self._folded_key = None
+        self._output_norm = None
+        self._norm_folded = False
+
+    def train(self, mode=True):
+        self._folded_params = None
+        self._folded_key = None
+        self._output_norm = None
+        self._norm_folded = False
+        return super().train(mode)
+
+    @torch.no_grad()
+    def _fold_parameters(self, x):
+        # batch norm applied to the output of the convolution: either our own one (post-activation) or the one of
+        # the following block (set by ResidualBlock.train)
+        if self._output_norm is not None:
+            norm = self._output_norm[0]
+        elif not self.preactivation:
+            norm = self.norm
+        else:
+            norm = None
+
+        weight = self.conv_layer.weight
+        sources = [weight]
+        if self.bias_param is not None:
+            sources.append(self.bias_param)
+        if norm is not None:
+            sources += [norm.weight, norm.bias, norm.running_mean, norm.running_var]
+
+        # The folded parameters have to be recomputed whenever one of their sources is replaced or updated in place,
+        # e.g. by load_state_dict or an exponential moving average of the weights
+        key = (x.dtype, x.device) + tuple((t.data_ptr(), _tensor_version(t)) for t in sources)
+        if key == self._folded_key:
+            return self._folded_params
+
+        if self.bias_param is not None:
+            bias = self.bias_param
+        else:
+            bias = weight.new_zeros(weight.shape[0])
+        if norm is not None:
+            scale, shift = _batch_norm_affine(norm)
+            weight = weight * scale.view((-1,) + (1,) * (weight.dim() - 1))
+            bias = bias * scale + shift
+
+        self._folded_params = weight.to(x.dtype), bias.to(x.dtype)
+        self._folded_key = key
+        return self._folded_params
+
+    def _pad(self, x):
+        if self._pad_mode == 'constant':
+            padded = F.pad(x, self._pad_spec, 'constant', 0.0)
+        else:
+            padded = F.pad(x, self._pad_spec, self._pad_mode)
+        if self._channels_last and not torch.jit.is_scripting():
+            padded = self._keep_channels_last(x, padded)
+        return padded
+
+    @torch.jit.unused
+    def _keep_channels_last(self, x, padded):
+        # type: (torch.Tensor, torch.Tensor) -> torch.Tensor
+        # some padding kernels return contiguous tensors, the convolution would then convert the layout back
+        if (
+                x.is_contiguous(memory_format=CHANNELS_LAST_3D)
+                and not padded.is_contiguous(memory_format=CHANNELS_LAST_3D)
+        ):
+            return padded.contiguous(memory_format=CHANNELS_LAST_3D)
+        return padded
+
+    def _pointwise(self, x):
+        # For channels_last_3d inputs the channels are already the innermost dimension and nn.Linear runs on a free
+        # view, its output is channels_last_3d as well. Other inputs go through the equivalent 1x1x1 convolution,
+        # which would otherwise need a copy and returns a contiguous tensor.
+        if self._channels_last and not torch.jit.is_scripting():
+            if self._is_channels_last(x):
+                return self.conv_layer(x.permute(0, 2, 3, 4, 1)).permute(0, 4, 1, 2, 3)
+        weight = self.conv_layer.weight
+        return F.conv3d(x, weight[:, :, None, None, None], self.conv_layer.bias)
+
+    @torch.jit.unused
+    def _is_channels_last(self, x):
+        # type: (torch.Tensor) -> bool
+        return x.is_contiguous(memory_format=CHANNELS_LAST_3D)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Checkpoints saved before the padding was inlined store the layers of an nn.Sequential
+        for index, name in enumerate(self._sequential_layers):
+            sequential_prefix = '{}convolutional_block.{}.'.format(prefix, index)
+            for key in [key for key in state_dict if key.startswith(sequential_prefix)]:
+                state_dict['{}{}.{}'.format(prefix, name, key[len(sequential_prefix):])] = state_dict.pop(key)
+
+        # and the bias of the convolution, 1x1x1 convolutions have since been replaced by linear layers
+        weight_key = prefix + 'conv_layer.weight'
+        bias_key = prefix + 'conv_layer.bias'
+        if self._linear:
+            if weight_key in state_dict and state_dict[weight_key].dim() == 5:
+                state_dict[weight_key] = state_dict[weight_key].flatten(1)
+        elif bias_key in state_dict:
+            state_dict[prefix + 'bias_param'] = state_dict.pop(bias_key)
+
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    @torch.jit.unused
+    def _can_fuse(self, x):
+        # type: (torch.Tensor) -> bool
+        return (
+            HAS_CUDNN_CONVOLUTION_RELU
+            and x.is_cuda
+            and x.dtype in (torch.float32, torch.float16)
+            and torch.backends.cudnn.enabled
+            # the fused kernel is not covered by autocast and would run in the precision of the input
+            and not torch.is_autocast_enabled()
+        )
 
-class Pad3d(nn.Module):
-    def __init__(self, pad, mode):
-        assert mode in PADDING_MODES.keys()
-        super().__init__()
-        self.pad = 6 * [pad]
-        self.mode = mode
+    @torch.jit.unused
+    def _fused_forward(self, x):
+        # type: (torch.Tensor) -> torch.Tensor
+        weight, bias = self._fold_parameters(x)
+        x = self._pad(x)
+        conv = self.conv_layer
+        return torch.cudnn_convolution_relu(x, weight, bias, conv.stride, conv.padding, conv.dilation, conv.groups)
+
+    @torch.jit.unused
+    def _folded_forward(self, x):
+        # type: (torch.Tensor) -> torch.Tensor
+        if self.norm is not None and not self._norm_folded:
+            x = self.norm(x)
+        if self.activation is not None:
+            x = self.activation(x)
+        if self.kernel_size > 1:
+            x = self._pad(x)
+        weight, bias = self._fold_parameters(x)
+        conv = self.conv_layer
+        conv_function = F.conv3d if weight.dim() == 5 else F.conv2d
+        x = conv_function(x, weight, None, conv.stride, conv.padding, conv.dilation, conv.groups)
+        return x.add_(bias.view(self._bias_shape))
+
+    @torch.jit.unused
+    def _can_fold(self):
+        # type: () -> bool
+        # The folded parameters are computed without autograd, they cannot be used when gradients are needed. When
+        # compiling, the compiler fuses the batch norms itself and the caching would only break its graph.
+        return not torch.is_grad_enabled() and not _is_compiling()
 
     def forward(self, x):
-        return F.pad(x, self.pad, self.mode)
+        fold = False
+        if not self.training and not torch.jit.is_scripting():
+            fold = self._can_fold()
+            if fold:
+                if self._fusable and self._can_fuse(x):
+                    return self._fused_forward(x)
+                if self._output_norm is not None:
+                    return self._folded_forward(x)
+
+        if self.preactivation:
+            if self.norm is not None and not (fold and self._norm_folded):
+                x = self.norm(x)
+            if self.activation is not None:
+                x = self.activation(x)
+        if self.kernel_size > 1:
+            x = self._pad(x)
+        if self._linear:
+            x = self._pointwise(x)
+        else:
+            x = self.conv_layer(x)
+        bias = self.bias_param
+        if bias is not None:
+            x.add_(bias.view(self._bias_shape))
+        if not self.preactivation:
+            if self.norm is not None:
+                x = self.norm(x)
+            if self.activation is not None:
+                x = self.activation(x)
+        return x
 
 
 class DilationBlock(nn.Module):
@@ -206,6 +509,7 @@ class DilationBlock(nn.Module):
             instance_norm=False,
             residual=True,
             padding_mode='constant',
+            use_checkpoint=False,
             ):
         super().__init__()
         self.in_channels = in_channels
@@ -222,6 +526,7 @@ class DilationBlock(nn.Module):
                 instance_norm=instance_norm,
                 residual=residual,
                 padding_mode=padding_mode,
+                use_checkpoint=use_checkpoint,
             )
             residual_blocks.append(residual_block)
             in_channels = out_channels
@@ -247,14 +552,34 @@ class HighResNet(nn.Module):
             residual=True,
             padding_mode='constant',
             add_dropout_layer=False,
+            jit=False,
+            compile=False,
+            cudnn_tuning=False,
+            use_checkpoint=False,
+            bfloat16=False,
+            expandable_segments=False,
             ):
         assert dimensions in (2, 3)
+        assert not (jit and compile)
+        # checkpointing is not available in scripted modules, see ResidualBlock for its effect on batch norms
+        assert not (jit and use_checkpoint)
+        assert not compile or hasattr(nn.Module, 'compile'), 'compile requires a more recent version of PyTorch'
+        assert not bfloat16 or hasattr(torch, 'autocast'), 'bfloat16 autocast requires a more recent version of PyTorch'
         super().__init__()
         self.in_channels = input_channels
         self.out_channels = output_channels
         self.layers_per_residual_block = layers_per_residual_block
         self.residual_blocks_per_dilation = residual_blocks_per_dilation
         self.dilations = dilations
+        self.dimensions = dimensions
+        self.channels_last = False
+        self.bfloat16 = bfloat16
+
+        # receptive field: (3 - 1) + sum_d(B * N * 2 ** (d + 1)) + 1, see receptive_field
+        B = layers_per_residual_block
+        N = residual_blocks_per_dilation
+        input_output_diff = (3 - 1) + sum(B * N * 2 ** (d + 1) for d in range(dilations))
+        self._receptive_field = input_output_diff + 1
 
         # List of blocks
         blocks = nn.ModuleList()
@@ -291,6 +616,7 @@ class HighResNet(nn.Module):
                 instance_norm=instance_norm,
                 residual=residual,
                 padding_mode=padding_mode,
+                use_checkpoint=use_checkpoint,
             )
             blocks.append(dilation_block)
             out_channels *= 2
@@ -332,12 +658,31 @@ class HighResNet(nn.Module):
         if outputs_activation == 'sigmoid':
             self.outputs_activation = nn.Sigmoid()
         elif outputs_activation == 'softmax':
-            self.outputs_activation = nn.Softmax()
+            self.outputs_activation = nn.Softmax(dim=CHANNELS_DIM)
+        elif outputs_activation == 'log_softmax':
+            # to be paired with NLLLoss, or use 'none' and let cross entropy compute the log softmax
+            self.outputs_activation = nn.LogSoftmax(dim=CHANNELS_DIM)
         elif outputs_activation == 'none':
             self.outputs_activation = nn.Identity()
 
         self.block = nn.Sequential(*blocks)
 
+        if jit:
+            # lets the JIT fuse the normalization, activation and residual additions
+            self.block = torch.jit.script(self.block)
+
+        if compile:
+            # Compiled in place with nn.Module.compile rather than wrapped by torch.compile, which keeps the keys of
+            # the state dict unchanged. The input shape is normally fixed, so inductor can specialize for it.
+            self.block.compile(mode='max-autotune', dynamic=False, fullgraph=True)
+            self.outputs_activation.compile(mode='max-autotune', dynamic=False, fullgraph=True)
+
+        if cudnn_tuning:
+            self.enable_cudnn_tuning()
+
+        if expandable_segments:
+            self._enable_expandable_segments()
+
     def forward(self, x):
         """
         Computes output of the network.
@@ -346,12 +691,117 @@ class HighResNet(nn.Module):
         :type x: torch.Tensor
         :return: prediction
         """
-        return self.outputs_activation(self.block(x))
+        if self.channels_last:
+            x = x.contiguous(memory_format=CHANNELS_LAST_3D)
+        if self.bfloat16:
+            with torch.autocast(device_type=x.device.type, dtype=torch.bfloat16):
+                out = self.outputs_activation(self.block(x))
+        else:
+            out = self.outputs_activation(self.block(x))
+        # the layers may produce channels_last_3d tensors, which only callers of to_channels_last_3d expect
+        if not self.channels_last:
+            out = out.contiguous()
+        return out
+
+    def to_channels_last_3d(self):
+        """
+        Stores the weights of all 3D convolutions in channels_last_3d memory format and converts inputs to the same
+        format in forward. This avoids layout conversions around each convolution. Inputs that are already in
+        channels_last_3d format are not copied.
+
+        :return: the network itself
+        """
+        assert self.dimensions == 3
+        assert CHANNELS_LAST_3D is not None, 'channels_last_3d requires a more recent version of PyTorch'
+        # Walks the parameters rather than the Conv3d modules, which are not visible once the blocks are scripted.
+        # The only 5-D parameters are the weights of the convolutions.
+        for parameter in self.block.parameters():
+            if parameter.dim() == 5:
+                parameter.data = parameter.data.contiguous(memory_format=CHANNELS_LAST_3D)
+        self.channels_last = True
+        return self
+
+    @classmethod
+    def enable_cudnn_tuning(cls, benchmark=True, tf32=True):
+        """
+        Lets cuDNN benchmark the available algorithms for every convolution and allows TF32 math on Ampere and newer
+        GPUs. Benchmark results are cached per input shape, this is therefore most effective when the network is
+        trained on patches of a fixed size. The settings are global and affect every model in the process.
+
+        :param benchmark: whether cuDNN should select convolution algorithms by benchmarking them
+        :type benchmark: bool
+        :param tf32: whether TF32 may be used for convolutions and matrix multiplications
+        :type tf32: bool
+        :return: None
+        """
+        torch.backends.cudnn.benchmark = benchmark
+        # TF32 switches are not available in older PyTorch releases
+        if hasattr(torch.backends.cudnn, 'allow_tf32'):
+            torch.backends.cudnn.allow_tf32 = tf32
+        if hasattr(torch.backends.cuda, 'matmul'):
+            torch.backends.cuda.matmul.allow_tf32 = tf32
+
+    def warmup(self, input_shape, iterations=3):
+        """
+        Runs a few training forward and backward passes on random data, so that cuDNN benchmarks and caches an
+        algorithm for every convolution before the actual training starts. The cached algorithms are only used while
+        cuDNN benchmarking is enabled, see cudnn_tuning and enable_cudnn_tuning, the previous value of
+        torch.backends.cudnn.benchmark is restored afterwards. Gradients, batch norm statistics, the training mode and
+        the state of the random number generators are restored as well.
+
+        :param input_shape: shape of the network input, including batch and channel dimensions
+        :type input_shape: list
+        :param iterations: number of forward and backward passes
+        :type iterations: int
+        :return: None
+        """
+        benchmark = torch.backends.cudnn.benchmark
+        torch.backends.cudnn.benchmark = True
+
+        parameter = next(self.parameters())
+        training = self.training
+        buffers = [buffer.clone() for buffer in self.buffers()]
+        # cleared so that the warm-up does not accumulate into the saved gradients in place
+        gradients = [p.grad for p in self.parameters()]
+        for p in self.parameters():
+            p.grad = None
+
+        self.train()
+        # the random input and the dropout layers would otherwise advance the global generators
+        devices = [parameter.device] if parameter.device.type == 'cuda' else []
+        with torch.random.fork_rng(devices=devices):
+            dummy = torch.randn(input_shape, dtype=parameter.dtype, device=parameter.device)
+            for _ in range(iterations):
+                self(dummy).sum().backward()
+        torch.backends.cudnn.benchmark = benchmark
+
+        # statistics first, eval mode folds the batch norms using them
+        with torch.no_grad():
+            for buffer, saved in zip(self.buffers(), buffers):
+                buffer.copy_(saved)
+        for p, gradient in zip(self.parameters(), gradients):
+            p.grad = gradient
+        self.train(training)
+
+    @classmethod
+    def _enable_expandable_segments(cls):
+        """
+        Makes the CUDA caching allocator grow expandable segments instead of allocating new blocks. The many
+        activations of different sizes produced by the network then do not fragment the cache. Equivalent to running
+        with PYTORCH_CUDA_ALLOC_CONF=expandable_segments:True. Applies to every CUDA allocation made afterwards,
+        including the weights once the network is moved to the GPU. Does nothing if CUDA is not available.
+
+        :return: None
+        """
+        assert hasattr(torch.cuda.memory, '_set_allocator_settings'), \
+            'expandable segments require a more recent version of PyTorch'
+        # the allocator settings are only bound in builds with CUDA support
+        if torch.cuda.is_available():
+            torch.cuda.memory._set_allocator_settings('expandable_segments:True')
 
     @property
     def num_parameters(self):
-        # pylint: disable=not-callable
-        return sum(torch.prod(torch.tensor(p.shape)) for p in self.parameters())
+        return sum(p.numel() for p in self.parameters())
 
     @property
     def receptive_field(self):
@@ -360,13 +810,7 @@ class HighResNet(nn.Module):
         N: number of residual blocks per dilation factor
         D: number of different dilation factors
         """
-        B = self.layers_per_residual_block
-        D = self.dilations
-        N = self.residual_blocks_per_dilation
-        d = torch.arange(D)
-        input_output_diff = (3 - 1) + torch.sum(B * N * 2 ** (d + 1))
-        receptive_field = input_output_diff + 1
-        return receptive_field
+        return self._receptive_field
 
     def get_receptive_field_world(self, spacing=1):
         return self.receptive_field * spacing
@@ -388,7 +832,7 @@ class HighRes2DNet(HighResNet):
         :type output_channels: int
         :param initial_out_channels_power: initial output channels power
         :type initial_out_channels_power: int
-        :param outputs_activation: output activation type either sigmoid, softmax or none
+        :param outputs_activation: output activation type either sigmoid, softmax, log_softmax or none
         :type outputs_activation: str
 
         <json>
@@ -398,7 +842,7 @@ class HighRes2DNet(HighResNet):
             {"name": "input_channels", "type": "int", "value": ""},
             {"name": "output_channels", "type": "int", "value": ""},
             {"name": "initial_out_channels_power", "type": "int", "value": "4"},
-            {"name": "outputs_activation", "type": "string", "value": ["sigmoid", "softmax", "none"]}
+            {"name": "outputs_activation", "type": "string", "value": ["sigmoid", "softmax", "log_softmax", "none"]}
         ]
         </json>
        """
@@ -429,7 +873,7 @@ class HighRes3DNet(HighResNet):
         :type output_channels: int
         :param initial_out_channels_power: initial output channels power
         :type initial_out_channels_power: int
-        :param outputs_activation: output activation type either sigmoid, softmax or none
+        :param outputs_activation: output activation type either sigmoid, softmax, log_softmax or none
         :type outputs_activation: str
 
         <json>
@@ -439,7 +883,7 @@ class HighRes3DNet(HighResNet):
             {"name": "input_channels", "type": "int", "value": ""},
             {"name": "output_channels", "type": "int", "value": ""},
             {"name": "initial_out_channels_power", "type": "int", "value": "4"},
-            {"name": "outputs_activation", "type": "string", "value": ["sigmoid", "softmax", "none"]}
+            {"name": "outputs_activation", "type": "string", "value": ["sigmoid", "softmax", "log_softmax", "none"]}
         ]
         </json>
        """
@@ -0,0 +1,356 @@
+import copy
+import pytest
+import torch
+
+from eisen.models.segmentation.highres3Dnet import ConvolutionalBlock
+from eisen.models.segmentation.highres3Dnet import HighRes2DNet
+from eisen.models.segmentation.highres3Dnet import HighRes3DNet
+from eisen.models.segmentation.highres3Dnet import ResidualBlock
+
+
+def randomize_batch_norms(model):
+    with torch.no_grad():
+        for module in model.modules():
+            if isinstance(module, torch.nn.modules.batchnorm._BatchNorm):
+                module.weight.uniform_(0.5, 1.5)
+                module.bias.uniform_(-0.5, 0.5)
+                module.running_mean.uniform_(-0.5, 0.5)
+                module.running_var.uniform_(0.5, 1.5)
+
+
+def unfolded_eval(model):
+    # eval mode without the overridden train methods, hence without batch norm folding
+    reference = copy.deepcopy(model)
+    reference.train()
+    for module in reference.modules():
+        module.training = False
+    return reference
+
+
+def legacy_state_dict(model):
+    # format of the checkpoints saved while ConvolutionalBlock held an nn.Sequential of biased convolutions
+    state_dict = model.state_dict()
+    for name, module in model.named_modules():
+        if not isinstance(module, ConvolutionalBlock):
+            continue
+        conv_index = module._sequential_layers.index('conv_layer')
+        renames = {
+            name + '.bias_param': '{}.convolutional_block.{}.bias'.format(name, conv_index),
+        }
+        for index, layer in enumerate(module._sequential_layers):
+            for key in state_dict:
+                if key.startswith('{}.{}.'.format(name, layer)):
+                    parameter = key[len('{}.{}.'.format(name, layer)):]
+                    renames[key] = '{}.convolutional_block.{}.{}'.format(name, index, parameter)
+        for key, legacy_key in renames.items():
+            if key in state_dict:
+                state_dict[legacy_key] = state_dict.pop(key)
+        if module._linear:
+            weight_key = '{}.convolutional_block.{}.weight'.format(name, conv_index)
+            state_dict[weight_key] = state_dict[weight_key][:, :, None, None, None]
+    return state_dict
+
+
+class TestHighRes3DNetStateDict:
+    def setup_class(self):
+        torch.manual_seed(0)
+        self.kwargs = dict(
+            initial_out_channels_power=2,
+            outputs_activation='none',
+            residual_blocks_per_dilation=1,
+            dilations=2,
+            add_dropout_layer=True,
+        )
+        self.model = HighRes3DNet(1, 2, batch_norm=False, **self.kwargs).eval()
+        self.data = torch.randn(1, 1, 8, 8, 8)
+
+    def test_load_legacy_state_dict(self):
+        model = HighRes3DNet(1, 2, batch_norm=False, **self.kwargs).eval()
+        model.load_state_dict(legacy_state_dict(self.model))
+
+        with torch.no_grad():
+            assert torch.allclose(model(self.data), self.model(self.data), atol=1e-5)
+
+    def test_contiguous_output(self):
+        with torch.no_grad():
+            assert self.model(self.data).is_contiguous()
+
+
+class TestHighRes3DNetFolding:
+    def setup_class(self):
+        torch.manual_seed(0)
+        self.model = HighRes3DNet(
+            2,
+            3,
+            initial_out_channels_power=2,
+            outputs_activation='none',
+            layers_per_residual_block=3,
+            residual_blocks_per_dilation=2,
+            dilations=2,
+            batch_norm=True,
+        )
+        randomize_batch_norms(self.model)
+        self.data = torch.randn(2, 2, 12, 12, 12)
+
+    def test_fold(self):
+        reference = unfolded_eval(self.model)
+
+        self.model.eval()
+
+        with torch.no_grad():
+            assert torch.allclose(self.model(self.data), reference(self.data), atol=1e-5)
+
+    def test_load_state_dict_in_eval(self):
+        self.model.eval()
+
+        with torch.no_grad():
+            self.model(self.data)
+
+            other = copy.deepcopy(self.model)
+            randomize_batch_norms(other)
+            self.model.load_state_dict(other.state_dict())
+
+            assert torch.allclose(self.model(self.data), unfolded_eval(other)(self.data), atol=1e-5)
+
+
+    def test_gradients_in_eval(self):
+        self.model.zero_grad()
+        reference = unfolded_eval(self.model)
+
+        self.model.eval()
+
+        self.model(self.data).sum().backward()
+        reference(self.data).sum().backward()
+
+        for parameter, reference_parameter in zip(self.model.parameters(), reference.parameters()):
+            assert parameter.grad is not None
+            assert torch.allclose(parameter.grad, reference_parameter.grad, atol=1e-4)
+
+    @pytest.mark.skipif(not hasattr(torch, 'inference_mode'), reason='inference mode is not available')
+    def test_moved_in_inference_mode(self):
+        model = copy.deepcopy(self.model)
+        reference = unfolded_eval(self.model).double()
+
+        with torch.inference_mode():
+            model = model.double().eval()
+
+            assert torch.allclose(model(self.data.double()), reference(self.data.double()), atol=1e-6)
+
+
+class TestHighRes2DNetFolding:
+    def setup_class(self):
+        torch.manual_seed(0)
+        self.model = HighRes2DNet(
+            1,
+            2,
+            initial_out_channels_power=2,
+            outputs_activation='none',
+            layers_per_residual_block=3,
+            residual_blocks_per_dilation=1,
+            dilations=2,
+            batch_norm=True,
+        )
+        randomize_batch_norms(self.model)
+        self.data = torch.randn(2, 1, 16, 16)
+
+    def test_fold(self):
+        reference = unfolded_eval(self.model)
+
+        self.model.eval()
+
+        with torch.no_grad():
+            assert torch.allclose(self.model(self.data), reference(self.data), atol=1e-5)
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason='CUDA is not available')
+class TestHighRes3DNetFusion:
+    def setup_class(self):
+        torch.manual_seed(0)
+        self.model = HighRes3DNet(
+            2,
+            3,
+            initial_out_channels_power=2,
+            outputs_activation='none',
+            residual_blocks_per_dilation=1,
+            dilations=2,
+            batch_norm=True,
+        ).cuda()
+        randomize_batch_norms(self.model)
+        self.data = torch.randn(2, 2, 12, 12, 12).cuda()
+
+    def test_fused_first_block(self):
+        reference = unfolded_eval(self.model)
+
+        self.model.eval()
+
+        with torch.no_grad():
+            assert torch.allclose(self.model(self.data), reference(self.data), atol=1e-4)
+
+
+@pytest.mark.skipif(not hasattr(torch.nn.Module, 'compile'), reason='nn.Module.compile is not available')
+class TestHighRes3DNetCompile:
+    def setup_class(self):
+        torch.manual_seed(0)
+        kwargs = dict(
+            initial_out_channels_power=2,
+            outputs_activation='none',
+            residual_blocks_per_dilation=1,
+            dilations=2,
+        )
+        self.model = HighRes3DNet(1, 2, **kwargs)
+        self.compiled = HighRes3DNet(1, 2, compile=True, **kwargs)
+        self.compiled.load_state_dict(self.model.state_dict())
+        self.data = torch.randn(1, 1, 8, 8, 8)
+
+    def test_forward(self):
+        self.model.train()
+        self.compiled.train()
+
+        assert torch.allclose(self.compiled(self.data), self.model(self.data), atol=1e-4)
+
+        self.model.eval()
+        self.compiled.eval()
+
+        with torch.no_grad():
+            assert torch.allclose(self.compiled(self.data), self.model(self.data), atol=1e-4)
+
+
+class TestHighRes3DNetCheckpoint:
+    def setup_class(self):
+        torch.manual_seed(0)
+        kwargs = dict(
+            initial_out_channels_power=2,
+            outputs_activation='none',
+            residual_blocks_per_dilation=2,
+            dilations=2,
+        )
+        self.model = HighRes3DNet(1, 2, **kwargs)
+        self.checkpointed = HighRes3DNet(1, 2, use_checkpoint=True, **kwargs)
+        self.checkpointed.load_state_dict(self.model.state_dict())
+        self.data = torch.randn(2, 1, 8, 8, 8)
+
+    def test_training_step(self):
+        self.model.train()
+        self.checkpointed.train()
+
+        loss = (self.model(self.data) ** 2).mean()
+        checkpointed_loss = (self.checkpointed(self.data) ** 2).mean()
+        loss.backward()
+        checkpointed_loss.backward()
+
+        assert torch.allclose(checkpointed_loss, loss, atol=1e-6)
+        for parameter, checkpointed_parameter in zip(self.model.parameters(), self.checkpointed.parameters()):
+            assert torch.allclose(checkpointed_parameter.grad, parameter.grad, atol=1e-5)
+
+
+class TestHighResNetScript:
+    def setup_class(self):
+        torch.manual_seed(0)
+        self.kwargs = dict(
+            initial_out_channels_power=2,
+            outputs_activation='none',
+            layers_per_residual_block=3,
+            residual_blocks_per_dilation=1,
+            dilations=2,
+            add_dropout_layer=False,
+        )
+
+    def compare(self, model_class, input_channels, data):
+        model = model_class(input_channels, 2, **self.kwargs)
+        scripted = model_class(input_channels, 2, jit=True, **self.kwargs)
+        scripted.load_state_dict(model.state_dict())
+
+        model.train()
+        scripted.train()
+
+        assert torch.allclose(scripted(data), model(data), atol=1e-5)
+
+        model.eval()
+        scripted.eval()
+
+        with torch.no_grad():
+            assert torch.allclose(scripted(data), model(data), atol=1e-5)
+
+    def test_highres3dnet(self):
+        self.compare(HighRes3DNet, 1, torch.randn(2, 1, 8, 8, 8))
+
+    def test_highres2dnet(self):
+        self.compare(HighRes2DNet, 3, torch.randn(2, 3, 16, 16))
+
+
+class TestResidualBlockShortcut:
+    def setup_class(self):
+        torch.manual_seed(0)
+        self.block = ResidualBlock(2, 4, 2, 1, 3, residual_type='pad')
+        randomize_batch_norms(self.block)
+        self.block.eval()
+
+    def check(self, block, data):
+        with torch.enable_grad():
+            # with autograd the shortcut is padded with F.pad on every call
+            expected = unfolded_eval(block)(data)
+        assert torch.allclose(block(data), expected, atol=1e-5)
+
+    def test_reuse(self):
+        block = copy.deepcopy(self.block)
+
+        with torch.no_grad():
+            for batch_size in (2, 2, 3, 2):
+                self.check(block, torch.randn(batch_size, 2, 4, 4, 4))
+
+            block.double()
+
+            self.check(block, torch.randn(2, 2, 4, 4, 4, dtype=torch.float64))
+
+    @pytest.mark.skipif(not hasattr(torch, 'inference_mode'), reason='inference mode is not available')
+    def test_reuse_in_inference_mode(self):
+        block = copy.deepcopy(self.block)
+
+        with torch.inference_mode():
+            self.check(block, torch.randn(2, 2, 4, 4, 4))
+        with torch.no_grad():
+            self.check(block, torch.randn(2, 2, 4, 4, 4))
+        with torch.inference_mode():
+            self.check(block, torch.randn(2, 2, 4, 4, 4))
+
+
+class TestHighRes3DNetWarmup:
+    def setup_class(self):
+        torch.manual_seed(0)
+        self.model = HighRes3DNet(
+            1,
+            2,
+            initial_out_channels_power=2,
+            layers_per_residual_block=2,
+            residual_blocks_per_dilation=1,
+            dilations=2,
+            add_dropout_layer=True,
+        )
+        randomize_batch_norms(self.model)
+        self.data = torch.randn(2, 1, 8, 8, 8)
+
+    def test_state_restored(self):
+        model = copy.deepcopy(self.model)
+        model(self.data).sum().backward()
+        model.eval()
+
+        gradients = [p.grad.clone() for p in model.parameters()]
+        buffers = [buffer.clone() for buffer in model.buffers()]
+        with torch.no_grad():
+            output = model(self.data)
+        benchmark = torch.backends.cudnn.benchmark
+        rng_state = torch.get_rng_state()
+
+        model.warmup([2, 1, 8, 8, 8], iterations=2)
+
+        assert not model.training
+        assert all(not module.training for module in model.modules())
+        assert torch.backends.cudnn.benchmark == benchmark
+        assert torch.equal(torch.get_rng_state(), rng_state)
+        for p, gradient in zip(model.parameters(), gradients):
+            assert torch.equal(p.grad, gradient)
+        for buffer, saved in zip(model.buffers(), buffers):
+            assert torch.equal(buffer, saved)
+        with torch.no_grad():
+            assert torch.allclose(model(self.data), output, atol=1e-6)
+